@@ -1,25 +1,97 @@
 """database.py — SQLite persistence for sessions and Q&A history."""
 
 import sqlite3
+import threading
 import uuid
-import json
-from datetime import datetime
-from typing import Optional, List, Dict
+from datetime import datetime, timedelta
+from operator import itemgetter
+from typing import Optional, List, Dict, Tuple, Iterator
+
+import orjson
+
+# Applied once when the long-lived connection is opened.
+PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "busy_timeout=5000",   # wait out another process's write lock, don't fail
+    "temp_store=memory",
+    "cache_size=-64000",
+    "mmap_size=268435456",
+)
+
+# Number of Q&A rows kept per session; older rows are pruned on save.
+MAX_HISTORY = 10
+
+# Upper bound on rows returned by search_history.
+SEARCH_LIMIT = 50
+
+# Semantic answer-cache entries kept per session, newest first, within the TTL.
+MAX_CACHED_ANSWERS = 100
+
+# Folds a qa_history result set into one JSON array inside SQLite, so the
+# rows are hydrated with a single orjson.loads call instead of two per row.
+_HISTORY_JSON = """
+    SELECT json_group_array(json_object(
+        'id',         id,
+        'session_id', session_id,
+        'question',   question,
+        'answer',     answer,
+        'snippets',   json(snippets),
+        'tags',       json(tags),
+        'created_at', created_at{rank}
+    ){order}) FROM ({inner})
+"""
+
+# ORDER BY inside an aggregate needs SQLite 3.44+. On older builds the
+# order json_group_array sees is undefined, so the decoded rows (at most
+# SEARCH_LIMIT) are sorted in Python instead.
+_AGGREGATE_ORDER_BY = sqlite3.sqlite_version_info >= (3, 44, 0)
+
+_NEWEST     = itemgetter("created_at")
+_NEWEST_ID  = itemgetter("created_at", "id")
+_BEST_MATCH = itemgetter("_rank")
+
+
+def _history_json(inner: str, order: str, rank: bool = False) -> str:
+    """_HISTORY_JSON over inner, whose rows must already be sorted by order.
+
+    rank=True also emits inner's _rank column so _decode_history can sort on it.
+    """
+    return _HISTORY_JSON.format(
+        inner=inner,
+        rank=",\n        '_rank',      _rank" if rank else "",
+        order=f" ORDER BY {order}" if _AGGREGATE_ORDER_BY else "",
+    )
+
+
+def _decode_history(packed: str, key, reverse: bool = False) -> List[Dict]:
+    """Hydrate a _HISTORY_JSON result, sorting it when SQLite couldn't."""
+    rows = orjson.loads(packed)
+    if not _AGGREGATE_ORDER_BY:
+        rows.sort(key=key, reverse=reverse)
+    return rows
 
 
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        # One connection for the lifetime of the process; autocommit mode so
+        # write transactions are delimited explicitly with BEGIN/COMMIT.
+        self._c = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._c.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            self._c.execute(f"PRAGMA {pragma}")
+        self._lock = threading.RLock()
         self._init_schema()
 
-    def _conn(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
-
     def _init_schema(self):
-        with self._conn() as conn:
-            conn.executescript("""
+        with self._lock:
+            has_fts = self._c.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='qa_fts'"
+            ).fetchone() is not None
+            self._c.executescript("""
                 CREATE TABLE IF NOT EXISTS sessions (
                     id          TEXT PRIMARY KEY,
                     source      TEXT NOT NULL,
@@ -39,91 +111,306 @@ class Database:
                 );
                 CREATE INDEX IF NOT EXISTS idx_qa_session
                     ON qa_history(session_id, created_at DESC);
+
+                -- Semantic answer cache: question embedding -> generated result.
+                CREATE TABLE IF NOT EXISTS qa_cache (
+                    session_id   TEXT NOT NULL,
+                    qhash        TEXT NOT NULL,
+                    qvec         BLOB NOT NULL,
+                    answer       TEXT NOT NULL,
+                    has_refactor INTEGER NOT NULL,
+                    created_at   TEXT NOT NULL,
+                    PRIMARY KEY (session_id, qhash)
+                );
+
+                -- Full-text index over question/answer, kept in sync by triggers.
+                -- Trigram tokens preserve the substring semantics of LIKE '%q%'.
+                -- Rows are keyed on qa_history's implicit rowid, which VACUUM may
+                -- renumber (there is no INTEGER PRIMARY KEY); nothing here runs
+                -- VACUUM, and anyone who does must follow it with
+                -- INSERT INTO qa_fts(qa_fts) VALUES('rebuild').
+                CREATE VIRTUAL TABLE IF NOT EXISTS qa_fts USING fts5(
+                    question, answer,
+                    content='qa_history', content_rowid='rowid',
+                    tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS qa_fts_ai AFTER INSERT ON qa_history BEGIN
+                    INSERT INTO qa_fts(rowid, question, answer)
+                    VALUES (new.rowid, new.question, new.answer);
+                END;
+                CREATE TRIGGER IF NOT EXISTS qa_fts_ad AFTER DELETE ON qa_history BEGIN
+                    INSERT INTO qa_fts(qa_fts, rowid, question, answer)
+                    VALUES ('delete', old.rowid, old.question, old.answer);
+                END;
+                -- Only text edits touch the index; tag updates leave it alone.
+                -- Dropped first so databases with the older catch-all trigger pick
+                -- up the column filter.
+                DROP TRIGGER IF EXISTS qa_fts_au;
+                CREATE TRIGGER qa_fts_au AFTER UPDATE OF question, answer ON qa_history BEGIN
+                    INSERT INTO qa_fts(qa_fts, rowid, question, answer)
+                    VALUES ('delete', old.rowid, old.question, old.answer);
+                    INSERT INTO qa_fts(rowid, question, answer)
+                    VALUES (new.rowid, new.question, new.answer);
+                END;
             """)
+            if not has_fts:
+                # First run against an existing DB: index the rows already there.
+                self._c.execute(
+                    "INSERT INTO qa_fts(rowid, question, answer) "
+                    "SELECT rowid, question, answer FROM qa_history"
+                )
 
     def ping(self):
-        with self._conn() as conn:
-            conn.execute("SELECT 1")
+        with self._lock:
+            self._c.execute("SELECT 1")
 
     def create_session(self, session_id: str, source: str, source_type: str, stats: dict):
-        with self._conn() as conn:
-            conn.execute(
+        with self._lock:
+            self._c.execute(
                 "INSERT INTO sessions VALUES (?,?,?,?,?)",
                 (session_id, source, source_type,
-                 json.dumps(stats), datetime.utcnow().isoformat())
+                 orjson.dumps(stats).decode(), datetime.utcnow().isoformat())
             )
 
     def get_session(self, session_id: str) -> Optional[Dict]:
-        with self._conn() as conn:
-            row = conn.execute(
+        with self._lock:
+            row = self._c.execute(
                 "SELECT * FROM sessions WHERE id=?", (session_id,)
             ).fetchone()
         if not row:
             return None
         d = dict(row)
-        d["stats"] = json.loads(d["stats"])
+        d["stats"] = orjson.loads(d["stats"])
         return d
 
     def save_qa(self, session_id: str, question: str, result: dict) -> str:
+        return self.save_qa_batch(session_id, question, result)
+
+    def save_qa_batch(self, session_id: str, question: str, result: dict,
+                      cache_entry: Optional[Tuple[str, bytes, float]] = None) -> str:
+        """Persist one answered question in a single transaction.
+
+        Inserts the history row, prunes the session to MAX_HISTORY and, when
+        cache_entry (qhash, qvec, max_age_s) is given, stores the result in
+        the semantic answer cache — one commit for the whole ask path.
+        """
         qa_id = str(uuid.uuid4())
-        with self._conn() as conn:
-            conn.execute(
-                "INSERT INTO qa_history VALUES (?,?,?,?,?,?,?)",
-                (qa_id, session_id, question,
-                 result.get("answer", ""),
-                 json.dumps(result.get("snippets", [])),
-                 "[]",
-                 datetime.utcnow().isoformat())
-            )
-            conn.execute("""
-                DELETE FROM qa_history
-                WHERE session_id=?
-                  AND id NOT IN (
+        with self._lock:
+            self._c.execute("BEGIN IMMEDIATE")
+            try:
+                self._insert_qa(qa_id, session_id, question, result)
+                if cache_entry is not None:
+                    self._insert_cache(session_id, *cache_entry, result)
+            except Exception:
+                self._c.execute("ROLLBACK")
+                raise
+            self._c.execute("COMMIT")
+        return qa_id
+
+    def _insert_qa(self, qa_id: str, session_id: str, question: str, result: dict):
+        self._c.execute(
+            "INSERT INTO qa_history VALUES (?,?,?,?,?,?,?)",
+            (qa_id, session_id, question,
+             result.get("answer", ""),
+             orjson.dumps(result.get("snippets", [])).decode(),
+             "[]",
+             datetime.utcnow().isoformat())
+        )
+        count = self._c.execute(
+            "SELECT COUNT(*) FROM qa_history WHERE session_id=?",
+            (session_id,)
+        ).fetchone()[0]
+        if count > MAX_HISTORY:
+            # Walks idx_qa_session once instead of a NOT IN anti-join.
+            self._c.execute("""
+                DELETE FROM qa_history WHERE id IN (
                     SELECT id FROM qa_history
                     WHERE session_id=?
-                    ORDER BY created_at DESC LIMIT 10
-                  )
-            """, (session_id, session_id))
-        return qa_id
+                    ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (session_id, MAX_HISTORY))
+
+    def get_cached_vectors(self, session_id: str, max_age_s: float,
+                           need_refactor: bool = False) -> List[Tuple[str, bytes]]:
+        """Unexpired (qhash, qvec) pairs from the semantic answer cache.
+
+        Answers aren't read here; load the chosen one with get_cached_answer.
+        """
+        cutoff = (datetime.utcnow() - timedelta(seconds=max_age_s)).isoformat()
+        with self._lock:
+            rows = self._c.execute(
+                "SELECT qhash, qvec FROM qa_cache "
+                "WHERE session_id=? AND created_at>? AND has_refactor>=?",
+                (session_id, cutoff, int(need_refactor))
+            ).fetchall()
+        return [(r["qhash"], r["qvec"]) for r in rows]
+
+    def get_cached_answer(self, session_id: str, qhash: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._c.execute(
+                "SELECT answer FROM qa_cache WHERE session_id=? AND qhash=?",
+                (session_id, qhash)
+            ).fetchone()
+        return None if row is None else orjson.loads(row["answer"])
+
+    def cache_answer(self, session_id: str, qhash: str, qvec: bytes,
+                     result: dict, max_age_s: float):
+        """Store a generated result, dropping this session's expired entries
+        and any beyond MAX_CACHED_ANSWERS."""
+        with self._lock:
+            self._c.execute("BEGIN IMMEDIATE")
+            try:
+                self._insert_cache(session_id, qhash, qvec, max_age_s, result)
+            except Exception:
+                self._c.execute("ROLLBACK")
+                raise
+            self._c.execute("COMMIT")
+
+    def _insert_cache(self, session_id: str, qhash: str, qvec: bytes,
+                      max_age_s: float, result: dict):
+        now = datetime.utcnow()
+        self._c.execute(
+            "DELETE FROM qa_cache WHERE session_id=? AND created_at<=?",
+            (session_id, (now - timedelta(seconds=max_age_s)).isoformat())
+        )
+        self._c.execute(
+            "INSERT OR REPLACE INTO qa_cache VALUES (?,?,?,?,?,?)",
+            (session_id, qhash, qvec, orjson.dumps(result).decode(),
+             int(bool(result.get("refactor_suggestions"))), now.isoformat())
+        )
+        self._c.execute("""
+            DELETE FROM qa_cache WHERE session_id=? AND qhash IN (
+                SELECT qhash FROM qa_cache WHERE session_id=?
+                ORDER BY created_at DESC, rowid DESC LIMIT -1 OFFSET ?
+            )
+        """, (session_id, session_id, MAX_CACHED_ANSWERS))
 
     def get_history(self, session_id: str, limit: int = 10) -> List[Dict]:
-        with self._conn() as conn:
-            rows = conn.execute(
-                "SELECT * FROM qa_history WHERE session_id=? "
-                "ORDER BY created_at DESC LIMIT ?",
+        with self._lock:
+            packed = self._c.execute(
+                _history_json(
+                    "SELECT * FROM qa_history WHERE session_id=? "
+                    "ORDER BY created_at DESC LIMIT ?",
+                    "created_at DESC"
+                ),
                 (session_id, limit)
-            ).fetchall()
-        result = []
-        for row in rows:
-            d = dict(row)
-            d["snippets"] = json.loads(d["snippets"])
-            d["tags"]     = json.loads(d["tags"])
-            result.append(d)
-        return result
+            ).fetchone()[0]
+        return _decode_history(packed, _NEWEST, reverse=True)
+
+    def count_history(self, session_id: str) -> int:
+        with self._lock:
+            return self._c.execute(
+                "SELECT COUNT(*) FROM qa_history WHERE session_id=?", (session_id,)
+            ).fetchone()[0]
+
+    def iter_history(self, session_id: str, limit: int = 100,
+                     page_size: int = 20) -> Iterator[Dict]:
+        """Yield history newest first, one keyset-paginated page at a time.
+
+        The lock is taken per page, never held while the caller consumes rows.
+        """
+        sent, last = 0, None
+        while sent < limit:
+            n = min(page_size, limit - sent)
+            with self._lock:
+                if last is None:
+                    packed = self._c.execute(
+                        _history_json(
+                            "SELECT * FROM qa_history WHERE session_id=? "
+                            "ORDER BY created_at DESC, id DESC LIMIT ?",
+                            "created_at DESC, id DESC"
+                        ),
+                        (session_id, n)
+                    ).fetchone()[0]
+                else:
+                    packed = self._c.execute(
+                        _history_json(
+                            "SELECT * FROM qa_history WHERE session_id=? "
+                            "AND (created_at, id) < (?, ?) "
+                            "ORDER BY created_at DESC, id DESC LIMIT ?",
+                            "created_at DESC, id DESC"
+                        ),
+                        (session_id, *last, n)
+                    ).fetchone()[0]
+            rows = _decode_history(packed, _NEWEST_ID, reverse=True)
+            yield from rows
+            if len(rows) < n:
+                return
+            sent += len(rows)
+            last  = (rows[-1]["created_at"], rows[-1]["id"])
 
     def update_tags(self, qa_id: str, tags: List[str]):
-        with self._conn() as conn:
-            conn.execute(
+        with self._lock:
+            self._c.execute(
                 "UPDATE qa_history SET tags=? WHERE id=?",
-                (json.dumps(tags), qa_id)
+                (orjson.dumps(tags).decode(), qa_id)
             )
 
+    def update_tags_bulk(self, pairs: List[Tuple[str, List[str]]]) -> int:
+        """Apply many (qa_id, tags) updates in a single transaction.
+
+        Returns the number of rows that matched an id.
+        """
+        with self._lock:
+            self._c.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._c.executemany(
+                    "UPDATE qa_history SET tags=? WHERE id=?",
+                    [(orjson.dumps(tags).decode(), qa_id) for qa_id, tags in pairs]
+                )
+            except Exception:
+                self._c.execute("ROLLBACK")
+                raise
+            self._c.execute("COMMIT")
+        return cur.rowcount
+
     def delete_qa(self, qa_id: str):
-        with self._conn() as conn:
-            conn.execute("DELETE FROM qa_history WHERE id=?", (qa_id,))
+        with self._lock:
+            self._c.execute("DELETE FROM qa_history WHERE id=?", (qa_id,))
+
+    def delete_qa_bulk(self, qa_ids: List[str]) -> int:
+        """Delete many Q&A rows in a single transaction; returns rows deleted."""
+        with self._lock:
+            self._c.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._c.executemany(
+                    "DELETE FROM qa_history WHERE id=?",
+                    [(qa_id,) for qa_id in qa_ids]
+                )
+            except Exception:
+                self._c.execute("ROLLBACK")
+                raise
+            self._c.execute("COMMIT")
+        return cur.rowcount
 
     def search_history(self, session_id: str, query: str) -> List[Dict]:
-        with self._conn() as conn:
-            rows = conn.execute(
-                "SELECT * FROM qa_history WHERE session_id=? "
-                "AND (question LIKE ? OR answer LIKE ?) "
-                "ORDER BY created_at DESC",
-                (session_id, f"%{query}%", f"%{query}%")
-            ).fetchall()
-        result = []
+        with self._lock:
+            if len(query) < 3:
+                # Trigram tokens need at least three characters to match.
+                packed = self._c.execute(
+                    _history_json(
+                        "SELECT * FROM qa_history WHERE session_id=? "
+                        "AND (question LIKE ? OR answer LIKE ?) "
+                        "ORDER BY created_at DESC LIMIT ?",
+                        "created_at DESC"
+                    ),
+                    (session_id, f"%{query}%", f"%{query}%", SEARCH_LIMIT)
+                ).fetchone()[0]
+                key, reverse = _NEWEST, True
+            else:
+                phrase = '"' + query.replace('"', '""') + '"'
+                packed = self._c.execute(
+                    _history_json(
+                        "SELECT qa.*, bm25(qa_fts) AS _rank FROM qa_fts "
+                        "JOIN qa_history qa ON qa.rowid = qa_fts.rowid "
+                        "WHERE qa_fts MATCH ? AND qa.session_id=? "
+                        "ORDER BY _rank LIMIT ?",
+                        "_rank", rank=True
+                    ),
+                    (phrase, session_id, SEARCH_LIMIT)
+                ).fetchone()[0]
+                key, reverse = _BEST_MATCH, False
+        rows = _decode_history(packed, key, reverse)
         for row in rows:
-            d = dict(row)
-            d["snippets"] = json.loads(d["snippets"])
-            d["tags"]     = json.loads(d["tags"])
-            result.append(d)
-        return result
\ No newline at end of file
+            row.pop("_rank", None)
+        return rows
\ No newline at end of file
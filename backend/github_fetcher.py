@@ -1,18 +1,32 @@
 """github_fetcher.py — Downloads a public GitHub repo as ZIP and extracts it."""
 
+import asyncio
 import os
 import re
-import zipfile
 from pathlib import Path
 from typing import Dict
 
 import httpx
 
+from .archive import extract_zip
+
 
 class GitHubFetcher:
     REPO_API = "https://api.github.com/repos/{owner}/{repo}"
     ZIP_URL  = "https://api.github.com/repos/{owner}/{repo}/zipball/{branch}"
 
+    def __init__(self):
+        # Shared across calls so the repo-info and zipball requests (and
+        # consecutive ingests) reuse one HTTP/2 connection to api.github.com.
+        self._client = httpx.AsyncClient(
+            timeout=30,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=4),
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
     def _parse(self, url: str):
         url = url.strip().rstrip("/")
         m   = re.search(r"github\.com[/:]([^/]+)/([^/\s]+?)(?:\.git)?$", url)
@@ -33,39 +47,40 @@ class GitHubFetcher:
         if token:
             headers["Authorization"] = f"Bearer {token}"
 
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(
-                self.REPO_API.format(owner=owner, repo=repo),
-                headers=headers
+        r = await self._client.get(
+            self.REPO_API.format(owner=owner, repo=repo),
+            headers=headers
+        )
+        if r.status_code == 404:
+            raise ValueError(
+                f"Repo not found: {owner}/{repo}. Make sure it's public."
             )
-            if r.status_code == 404:
-                raise ValueError(
-                    f"Repo not found: {owner}/{repo}. Make sure it's public."
-                )
-            if r.status_code != 200:
-                raise ValueError(f"GitHub API error: {r.status_code}")
-
-            info    = r.json()
-            branch  = info.get("default_branch", "main")
-            size_kb = info.get("size", 0)
-            if size_kb > 50_000:
-                raise ValueError(
-                    f"Repo is too large ({size_kb // 1024} MB). Limit is 50 MB."
-                )
+        if r.status_code != 200:
+            raise ValueError(f"GitHub API error: {r.status_code}")
 
-            zr = await client.get(
-                self.ZIP_URL.format(owner=owner, repo=repo, branch=branch),
-                headers=headers,
-                follow_redirects=True
+        info    = r.json()
+        branch  = info.get("default_branch", "main")
+        size_kb = info.get("size", 0)
+        if size_kb > 50_000:
+            raise ValueError(
+                f"Repo is too large ({size_kb // 1024} MB). Limit is 50 MB."
             )
-            if zr.status_code != 200:
-                raise ValueError(f"Failed to download ZIP: {zr.status_code}")
 
-            zip_path = dest / "repo.zip"
-            zip_path.write_bytes(zr.content)
+        zip_path = dest / "repo.zip"
+        async with self._client.stream(
+            "GET",
+            self.ZIP_URL.format(owner=owner, repo=repo, branch=branch),
+            headers=headers,
+            follow_redirects=True
+        ) as resp:
+            if resp.status_code != 200:
+                raise ValueError(f"Failed to download ZIP: {resp.status_code}")
+            # Written as it arrives; the archive is never held in memory.
+            with open(zip_path, "wb") as f:
+                async for chunk in resp.aiter_bytes(65536):
+                    f.write(chunk)
 
-        with zipfile.ZipFile(str(zip_path), "r") as zf:
-            zf.extractall(str(dest))
+        await asyncio.to_thread(extract_zip, str(zip_path), str(dest))
         zip_path.unlink()
 
         return {
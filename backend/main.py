@@ -4,27 +4,28 @@ main.py — FastAPI application for CodeLens: Codebase Q&A with Proof.
 Production hardening:
   - Structured JSON logging (Python logging module, not bare print)
   - Per-IP rate limiting via slowapi
-  - Asyncio semaphore — max 3 concurrent indexing jobs
+  - Asyncio semaphores — max 3 concurrent indexing jobs, 5 GitHub downloads
   - UUID format validation on all session_id parameters
   - Zip-slip attack prevention on ZIP extraction
   - Request-ID header on every response for traceability
 """
 
 import os
-import re
 import time
+import hashlib
 import uuid
 import zipfile
 import shutil
 import logging
 import asyncio
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Tuple
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -35,10 +36,11 @@ from .database       import Database
 from .indexer        import CodebaseIndexer
 from .qa_engine      import QAEngine
 from .github_fetcher import GitHubFetcher
+from .archive        import extract_zip
 
 # ── Logging ───────────────────────────────────────────────────────────────────
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='{"time":"%(asctime)s","level":"%(levelname)s","logger":"%(name)s","msg":%(message)s}',
     datefmt="%Y-%m-%dT%H:%M:%SZ",
 )
@@ -50,16 +52,47 @@ limiter = Limiter(key_func=get_remote_address, default_limits=["200/minute"])
 # ── Concurrency guard (max 3 simultaneous indexing jobs) ─────────────────────
 INDEX_SEMAPHORE = asyncio.Semaphore(3)
 
+# ── Concurrency guard (max 5 simultaneous GitHub downloads) ──────────────────
+# Caps outbound zipball fetches so bursts of ingests don't trip GitHub's 429s.
+GITHUB_SEMAPHORE = asyncio.Semaphore(5)
+
+# ── In-flight /api/ask calls, for coalescing duplicates ──────────────────────
+INFLIGHT: Dict[str, asyncio.Future] = {}
+
 # ── UUID validation helper ────────────────────────────────────────────────────
-UUID_RE = re.compile(
-    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
-)
+def _canonical_uuid(value: str) -> str:
+    """Return value as a lower-case hyphenated UUID; ValueError if it isn't one.
+
+    uuid.UUID does the hex parse in C, which is cheaper than a regex match.
+    """
+    return str(uuid.UUID(value))
 
 def validate_session_id(session_id: str) -> str:
     """Raise 400 if session_id is not a valid UUID."""
-    if not UUID_RE.match(session_id.lower()):
+    try:
+        return _canonical_uuid(session_id)
+    except ValueError:
         raise HTTPException(400, "Invalid session_id format.")
-    return session_id.lower()
+
+# ── Session directories ──────────────────────────────────────────────────────
+_CLEANUP_TASKS: set = set()   # strong refs so pending deletions aren't GC'd
+
+def _new_session_dir() -> Tuple[str, Path]:
+    """Create the upload directory for a new session, named by its UUID.
+
+    mkdir without exist_ok is itself the atomic existence check.
+    """
+    session_id  = str(uuid.uuid4())
+    session_dir = UPLOAD_DIR / session_id
+    session_dir.mkdir()
+    return session_id, session_dir
+
+def _discard(session_dir: Path) -> None:
+    """Remove a failed session's files without holding up the error response."""
+    task = asyncio.create_task(
+        asyncio.to_thread(shutil.rmtree, str(session_dir), ignore_errors=True))
+    _CLEANUP_TASKS.add(task)
+    task.add_done_callback(_CLEANUP_TASKS.discard)
 
 # ── App ───────────────────────────────────────────────────────────────────────
 app = FastAPI(title="CodeLens — Codebase Q&A", version="1.0.0")
@@ -72,18 +105,43 @@ app.add_middleware(
 
 BASE_DIR     = Path(__file__).parent.parent
 FRONTEND_DIR = BASE_DIR / "frontend"
-UPLOAD_DIR   = BASE_DIR / "uploads"
-INDEX_DIR    = BASE_DIR / "indexes"
+# Storage locations can be moved out of the checkout (tests point them at a
+# temp dir so they never touch the bundled sample data).
+UPLOAD_DIR   = Path(os.getenv("UPLOAD_DIR", BASE_DIR / "uploads"))
+INDEX_DIR    = Path(os.getenv("INDEX_DIR", BASE_DIR / "indexes"))
+DB_PATH      = Path(os.getenv("DB_PATH", BASE_DIR / "qa_history.db"))
+
+MAX_UPLOAD_BYTES   = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE  = 1024 * 1024   # bytes copied to disk per read
+MAX_UPLOAD_BODY    = MAX_UPLOAD_BYTES + 64 * 1024   # allows for multipart framing
+EXPORT_MAX_RECORDS = 100
 
 UPLOAD_DIR.mkdir(exist_ok=True)
 INDEX_DIR.mkdir(exist_ok=True)
 
-db             = Database(str(BASE_DIR / "qa_history.db"))
+db             = Database(str(DB_PATH))
 indexer        = CodebaseIndexer(str(INDEX_DIR))
-qa_engine      = QAEngine(indexer)
+qa_engine      = QAEngine(indexer, db)
 github_fetcher = GitHubFetcher()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await github_fetcher.aclose()
+
+
+# ── Upload size guard ────────────────────────────────────────────────────────
+# Rejects oversize uploads from Content-Length alone, before the multipart
+# body is read. Registered first so the request-ID middleware wraps it.
+@app.middleware("http")
+async def upload_size_guard(request: Request, call_next):
+    if request.url.path == "/api/upload":
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > MAX_UPLOAD_BODY:
+            return JSONResponse({"detail": "ZIP exceeds 50 MB limit."}, status_code=400)
+    return await call_next(request)
+
+
 # ── Request-ID + access log middleware ───────────────────────────────────────
 @app.middleware("http")
 async def request_id_middleware(request: Request, call_next):
@@ -104,13 +162,15 @@ class QuestionRequest(BaseModel):
     session_id: str
     question: str
     generate_refactor: bool = False
+    no_cache: bool = False   # skip the semantic answer cache for sensitive prompts
 
     @field_validator("session_id")
     @classmethod
     def check_session_id(cls, v: str) -> str:
-        if not UUID_RE.match(v.lower()):
+        try:
+            return _canonical_uuid(v)
+        except ValueError:
             raise ValueError("session_id must be a valid UUID")
-        return v.lower()
 
     @field_validator("question")
     @classmethod
@@ -146,6 +206,26 @@ class TagRequest(BaseModel):
             raise ValueError("Maximum 20 tags per Q&A")
         return [t.strip().lower()[:32] for t in v if t.strip()]
 
+class TagBulkRequest(BaseModel):
+    items: List[TagRequest]
+
+    @field_validator("items")
+    @classmethod
+    def check_items(cls, v: List[TagRequest]) -> List[TagRequest]:
+        if len(v) > 100:
+            raise ValueError("Maximum 100 Q&As per bulk tag request")
+        return v
+
+class DeleteBulkRequest(BaseModel):
+    qa_ids: List[str]
+
+    @field_validator("qa_ids")
+    @classmethod
+    def check_qa_ids(cls, v: List[str]) -> List[str]:
+        if len(v) > 100:
+            raise ValueError("Maximum 100 Q&As per bulk delete request")
+        return v
+
 class SearchRequest(BaseModel):
     session_id: str
     query: str
@@ -164,6 +244,33 @@ async def status_page():
 
 
 # ── Health ────────────────────────────────────────────────────────────────────
+LLM_PROBE_TTL_S = 30   # seconds a Gemini list_models() probe result is reused
+_llm_probe      = {"ts": 0.0, "key": "", "status": None}
+_llm_probe_lock = threading.Lock()
+
+
+def _probe_llm(key: str) -> dict:
+    """Gemini reachability, re-probed at most once per LLM_PROBE_TTL_S.
+
+    Holding the lock while probing means a burst of health checks triggers
+    one list_models() call; a recent failure is reported, not retried.
+    """
+    with _llm_probe_lock:
+        if (_llm_probe["key"] == key and _llm_probe["status"] is not None
+                and time.time() - _llm_probe["ts"] < LLM_PROBE_TTL_S):
+            return _llm_probe["status"]
+        try:
+            import google.generativeai as genai
+            genai.configure(api_key=key)
+            next(iter(genai.list_models()), None)
+            status = {"status": "ok", "message": "Gemini connected (gemini-1.5-flash-latest + gemini-embedding-001)"}
+        except Exception as e:
+            logger.error('"event":"gemini_ping_failed","error":"%s"', str(e)[:120])
+            status = {"status": "error", "message": str(e)[:120]}
+        _llm_probe.update(ts=time.time(), key=key, status=status)
+        return status
+
+
 @app.get("/api/health")
 async def health():
     t0      = time.time()
@@ -180,14 +287,7 @@ async def health():
     if not key:
         llm = {"status": "error", "message": "GEMINI_API_KEY not configured"}
     else:
-        try:
-            import google.generativeai as genai
-            genai.configure(api_key=key)
-            next(iter(genai.list_models()), None)
-            llm = {"status": "ok", "message": "Gemini connected (gemini-1.5-flash-latest + gemini-embedding-001)"}
-        except Exception as e:
-            logger.error('"event":"gemini_ping_failed","error":"%s"', str(e)[:120])
-            llm = {"status": "error", "message": str(e)[:120]}
+        llm = await asyncio.to_thread(_probe_llm, key)
 
     overall = "ok" if all(
         s["status"] == "ok" for s in [backend, database, llm]
@@ -209,49 +309,48 @@ async def upload_zip(request: Request, file: UploadFile = File(...)):
         raise HTTPException(400, "No file provided.")
     if not file.filename.lower().endswith(".zip"):
         raise HTTPException(400, "Only .zip files are accepted.")
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(400, "ZIP exceeds 50 MB limit.")
 
-    session_id  = str(uuid.uuid4())
-    session_dir = UPLOAD_DIR / session_id
-    session_dir.mkdir(parents=True)
+    session_id, session_dir = _new_session_dir()
     logger.info('"event":"upload_start","session":"%s","file":"%s"',
                 session_id, file.filename)
 
     try:
-        content = await file.read()
-        if len(content) > 50 * 1024 * 1024:
-            shutil.rmtree(str(session_dir))
-            raise HTTPException(400, "ZIP exceeds 50 MB limit.")
-
         zip_path    = session_dir / "code.zip"
         extract_dir = session_dir / "source"
-        zip_path.write_bytes(content)
+
+        # Stream to disk so peak memory stays at one chunk, not the whole ZIP.
+        with open(zip_path, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                out.write(chunk)
+                if out.tell() > MAX_UPLOAD_BYTES:
+                    break
+        if zip_path.stat().st_size > MAX_UPLOAD_BYTES:
+            _discard(session_dir)
+            raise HTTPException(400, "ZIP exceeds 50 MB limit.")
 
         try:
-            with zipfile.ZipFile(str(zip_path), "r") as zf:
-                # Zip-slip prevention: reject any member that escapes extract_dir
-                resolved_root = extract_dir.resolve()
-                for member in zf.namelist():
-                    dest = (extract_dir / member).resolve()
-                    if not str(dest).startswith(str(resolved_root)):
-                        shutil.rmtree(str(session_dir))
-                        raise HTTPException(400, "Invalid ZIP: path traversal detected.")
-                zf.extractall(str(extract_dir))
+            await asyncio.to_thread(extract_zip, str(zip_path), str(extract_dir))
+        except ValueError as e:
+            _discard(session_dir)
+            raise HTTPException(400, str(e))
         except zipfile.BadZipFile:
-            shutil.rmtree(str(session_dir))
+            _discard(session_dir)
             raise HTTPException(400, "Invalid or corrupted ZIP file.")
 
         logger.info('"event":"extracted","session":"%s"', session_id)
 
         async with INDEX_SEMAPHORE:
             try:
-                stats = await asyncio.to_thread(
-                    indexer.index_directory, session_id, str(extract_dir)
+                stats = await indexer.index_directory_async(
+                    session_id, str(extract_dir)
                 )
             except ValueError as e:
-                shutil.rmtree(str(session_dir))
+                _discard(session_dir)
                 raise HTTPException(400, str(e))
             except Exception:
-                shutil.rmtree(str(session_dir))
+                _discard(session_dir)
                 logger.exception('"event":"index_error","session":"%s"', session_id)
                 raise HTTPException(500, "Indexing failed. Please try again.")
 
@@ -264,8 +363,7 @@ async def upload_zip(request: Request, file: UploadFile = File(...)):
         raise
     except Exception:
         logger.exception('"event":"upload_unexpected","session":"%s"', session_id)
-        if session_dir.exists():
-            shutil.rmtree(str(session_dir))
+        _discard(session_dir)
         raise HTTPException(500, "Upload failed. Please try again.")
 
 
@@ -273,35 +371,34 @@ async def upload_zip(request: Request, file: UploadFile = File(...)):
 @app.post("/api/github")
 @limiter.limit("5/minute")
 async def ingest_github(request: Request, req: GithubRequest):
-    session_id  = str(uuid.uuid4())
-    session_dir = UPLOAD_DIR / session_id
-    session_dir.mkdir(parents=True)
+    session_id, session_dir = _new_session_dir()
     logger.info('"event":"github_start","session":"%s","url":"%s"',
                 session_id, req.repo_url)
 
     try:
         extract_dir = session_dir / "source"
         try:
-            meta = await github_fetcher.fetch_and_extract(
-                req.repo_url.strip(), str(extract_dir))
+            async with GITHUB_SEMAPHORE:
+                meta = await github_fetcher.fetch_and_extract(
+                    req.repo_url.strip(), str(extract_dir))
         except ValueError as e:
-            shutil.rmtree(str(session_dir))
+            _discard(session_dir)
             raise HTTPException(400, str(e))
         except Exception:
-            shutil.rmtree(str(session_dir))
+            _discard(session_dir)
             logger.exception('"event":"github_fetch_error","session":"%s"', session_id)
             raise HTTPException(500, "GitHub fetch failed. Is the repo public?")
 
         async with INDEX_SEMAPHORE:
             try:
-                stats = await asyncio.to_thread(
-                    indexer.index_directory, session_id, str(extract_dir)
+                stats = await indexer.index_directory_async(
+                    session_id, str(extract_dir)
                 )
             except ValueError as e:
-                shutil.rmtree(str(session_dir))
+                _discard(session_dir)
                 raise HTTPException(400, str(e))
             except Exception:
-                shutil.rmtree(str(session_dir))
+                _discard(session_dir)
                 logger.exception('"event":"index_error","session":"%s"', session_id)
                 raise HTTPException(500, "Indexing failed. Please try again.")
 
@@ -315,15 +412,14 @@ async def ingest_github(request: Request, req: GithubRequest):
         raise
     except Exception:
         logger.exception('"event":"github_unexpected","session":"%s"', session_id)
-        if session_dir.exists():
-            shutil.rmtree(str(session_dir))
+        _discard(session_dir)
         raise HTTPException(500, "GitHub ingest failed. Please try again.")
 
 
 # ── Session ───────────────────────────────────────────────────────────────────
 @app.get("/api/sessions/{session_id}")
 async def get_session(session_id: str):
-    validate_session_id(session_id)
+    session_id = validate_session_id(session_id)
     s = db.get_session(session_id)
     if not s:
         raise HTTPException(404, "Session not found.")
@@ -331,12 +427,47 @@ async def get_session(session_id: str):
 
 
 # ── Ask ───────────────────────────────────────────────────────────────────────
+async def _answer_once(req: QuestionRequest) -> dict:
+    """Run qa_engine.answer in a worker thread, coalescing identical asks.
+
+    Concurrent requests for the same session, question and options await
+    the first caller's task instead of issuing their own Gemini calls, so
+    coalesced callers share one answer, one qa_id and one history row.
+    """
+    key = hashlib.blake2b(
+        f"{req.session_id}\0{req.generate_refactor}\0{req.no_cache}\0{req.question}"
+        .encode("utf-8"), digest_size=16,
+    ).hexdigest()
+    task = INFLIGHT.get(key)
+    if task is not None:
+        logger.info('"event":"ask_coalesced","session":"%s"', req.session_id)
+    else:
+        # The task is detached from this request: a disconnecting leader
+        # must not cancel the call its followers are waiting on.
+        task = asyncio.ensure_future(asyncio.to_thread(
+            qa_engine.answer, req.session_id, req.question, req.generate_refactor,
+            not req.no_cache,
+        ))
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _finish_inflight(key, t))
+    return dict(await asyncio.shield(task))
+
+
+def _finish_inflight(key: str, task: asyncio.Future) -> None:
+    if INFLIGHT.get(key) is task:
+        del INFLIGHT[key]
+    if not task.cancelled():
+        task.exception()   # retrieved here, so no "never retrieved" warning if every caller left
+
+
 @app.post("/api/ask")
 @limiter.limit("30/minute")
 async def ask(request: Request, req: QuestionRequest):
     if not db.get_session(req.session_id):
         raise HTTPException(404, "Session not found. Please upload a codebase first.")
-    if not indexer.has_index(req.session_id):
+    # A legacy session's first has_index() rewrites its index; keep that
+    # file I/O off the event loop.
+    if not await asyncio.to_thread(indexer.has_index, req.session_id):
         raise HTTPException(400, "Index missing. Please re-upload the codebase.")
 
     logger.info('"event":"ask","session":"%s","q_len":%d',
@@ -344,9 +475,7 @@ async def ask(request: Request, req: QuestionRequest):
     t0 = time.time()
 
     try:
-        result = await asyncio.to_thread(
-            qa_engine.answer, req.session_id, req.question, req.generate_refactor
-        )
+        result = await _answer_once(req)
     except ValueError as e:
         raise HTTPException(400, str(e))
     except Exception:
@@ -355,19 +484,18 @@ async def ask(request: Request, req: QuestionRequest):
 
     ms = round((time.time() - t0) * 1000)
     logger.info('"event":"ask_complete","session":"%s","ms":%d', req.session_id, ms)
-    result["qa_id"] = db.save_qa(req.session_id, req.question, result)
     return result
 
 
 # ── History ───────────────────────────────────────────────────────────────────
 @app.get("/api/history/{session_id}")
 async def history(session_id: str, limit: int = 10):
-    validate_session_id(session_id)
+    session_id = validate_session_id(session_id)
     return {"history": db.get_history(session_id, min(limit, 50))}
 
 @app.post("/api/search-history")
 async def search_history(req: SearchRequest):
-    validate_session_id(req.session_id)
+    req.session_id = validate_session_id(req.session_id)
     if not req.query.strip():
         raise HTTPException(400, "Search query cannot be empty.")
     return {"results": db.search_history(req.session_id, req.query.strip()[:200])}
@@ -377,45 +505,59 @@ async def tag_qa(req: TagRequest):
     db.update_tags(req.qa_id, req.tags)
     return {"status": "ok"}
 
+@app.post("/api/tags-bulk")
+async def tag_qa_bulk(req: TagBulkRequest):
+    updated = db.update_tags_bulk([(item.qa_id, item.tags) for item in req.items])
+    return {"status": "ok", "updated": updated}
+
 @app.delete("/api/history/{qa_id}")
 async def delete_qa(qa_id: str):
     db.delete_qa(qa_id)
     return {"status": "deleted"}
 
+@app.post("/api/history-delete-bulk")
+async def delete_qa_bulk(req: DeleteBulkRequest):
+    return {"status": "deleted", "deleted": db.delete_qa_bulk(req.qa_ids)}
+
 
 # ── Export ────────────────────────────────────────────────────────────────────
 @app.get("/api/export/{session_id}")
 async def export_session(session_id: str):
-    validate_session_id(session_id)
+    session_id = validate_session_id(session_id)
     session = db.get_session(session_id)
     if not session:
         raise HTTPException(404, "Session not found.")
 
-    records = db.get_history(session_id, 100)
-    lines   = [
-        "# Codebase Q&A Export", "",
-        f"**Source**: `{session['source']}`",
-        f"**Exported**: {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}",
-        f"**Total Q&As**: {len(records)}", "", "---", "",
-    ]
-    for i, rec in enumerate(records, 1):
-        tags_str = ", ".join(f"`{t}`" for t in rec.get("tags", [])) or "_none_"
-        lines += [
-            f"## Q{i}: {rec['question']}", "",
-            f"**Tags**: {tags_str}", "", "### Answer", "", rec["answer"], "",
-        ]
-        for s in rec.get("snippets", [])[:3]:
-            lines += [
-                f"**`{s['file']}` (lines {s['line_start']}–{s['line_end']})**",
-                f"```{s.get('language', '')}",
-                s["raw"][:600] + ("..." if len(s["raw"]) > 600 else ""),
-                "```", "",
+    total = min(db.count_history(session_id), EXPORT_MAX_RECORDS)
+
+    # Sync generator: Starlette iterates it in the threadpool, so the paged
+    # DB reads stay off the event loop and each record is sent as it's built.
+    def _markdown():
+        yield "\n".join([
+            "# Codebase Q&A Export", "",
+            f"**Source**: `{session['source']}`",
+            f"**Exported**: {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}",
+            f"**Total Q&As**: {total}", "", "---", "",
+        ])
+        for i, rec in enumerate(db.iter_history(session_id, EXPORT_MAX_RECORDS), 1):
+            tags_str = ", ".join(f"`{t}`" for t in rec.get("tags", [])) or "_none_"
+            lines = [
+                "", f"## Q{i}: {rec['question']}", "",
+                f"**Tags**: {tags_str}", "", "### Answer", "", rec["answer"], "",
             ]
-        lines += ["---", ""]
-
-    return Response(
-        content="\n".join(lines),
+            for s in rec.get("snippets", [])[:3]:
+                lines += [
+                    f"**`{s['file']}` (lines {s['line_start']}–{s['line_end']})**",
+                    f"```{s.get('language', '')}",
+                    s["raw"][:600] + ("..." if len(s["raw"]) > 600 else ""),
+                    "```", "",
+                ]
+            lines += ["---", ""]
+            yield "\n".join(lines)
+
+    return StreamingResponse(
+        _markdown(),
         media_type="text/markdown",
         headers={"Content-Disposition":
                  f'attachment; filename="codebase_qa_{session_id[:8]}.md"'},
-    )
\ No newline at end of file
+    )
@@ -2,38 +2,159 @@
 qa_engine.py — Q&A using gemini-embedding-001 retrieval + Gemini 2.5 Flash generation.
 """
 
+import io
 import os
+import hashlib
 import logging
-from typing import Dict, Any
-from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
 
+import numpy as np
 import google.generativeai as genai
 
+from .database import Database
 from .indexer import CodebaseIndexer
 
 logger = logging.getLogger("codelens.qa")
 
 GEMINI_MODEL = "gemini-2.5-flash"   # confirmed working on this API key
 
+ANSWER_CACHE_MIN_SIM = 0.95          # cosine needed to reuse a prior answer
+ANSWER_CACHE_TTL_S   = 24 * 3600
+REFACTOR_WORKERS     = 4             # concurrent refactor calls across all asks
+
+SNIPPET_PROMPT_CHARS = 1200          # per-chunk source kept in the prompt
+
+# Static prompt text, split around the dynamic parts and joined per call.
+_PROMPT_PREFIX = (
+    "You are an expert code analyst. Answer the developer's question "
+    "using ONLY the provided code snippets below.\n\n"
+    "QUESTION: "
+)
+_PROMPT_MIDDLE = "\n\nCODE SNIPPETS:\n"
+_PROMPT_SUFFIX = (
+    "\n\n"
+    "INSTRUCTIONS:\n"
+    "- Give a clear, direct answer referencing specific file paths and line numbers.\n"
+    "- Format file references like: `filename.py (lines X-Y)`\n"
+    "- Quote short inline code using backticks when helpful.\n"
+    "- If the answer spans multiple files, explain how they interact.\n"
+    "- If the question cannot be answered from the snippets, say so clearly.\n"
+    "- Do NOT invent file paths or code that is not in the snippets.\n\n"
+    "Respond in markdown format."
+)
+
+_REFACTOR_PREFIX = (
+    "You are a senior software engineer. "
+    "Review this code and give 3-5 concrete refactor suggestions.\n\n"
+    "File: "
+)
+_REFACTOR_SUFFIX = (
+    "\n```\n\n"
+    "Format each suggestion as:\n"
+    "**Issue**: [problem]\n"
+    "**Suggestion**: [fix]\n"
+    "**Why**: [reason]"
+)
+
+# Snippet language tags for the frontend's syntax highlighter.
+_EXT_MAP = {
+    ".py": "python",   ".js": "javascript", ".ts": "typescript",
+    ".jsx": "jsx",     ".tsx": "tsx",        ".java": "java",
+    ".go": "go",       ".rb": "ruby",        ".rs": "rust",
+    ".cpp": "cpp",     ".c": "c",            ".h": "c",
+    ".hpp": "cpp",     ".cs": "csharp",      ".php": "php",
+    ".swift": "swift", ".kt": "kotlin",      ".sh": "bash",
+    ".bash": "bash",   ".yml": "yaml",       ".yaml": "yaml",
+    ".toml": "toml",   ".json": "json",      ".sql": "sql",
+    ".html": "html",   ".css": "css",        ".md": "markdown",
+}
+
 
 class QAEngine:
-    def __init__(self, indexer: CodebaseIndexer):
+    def __init__(self, indexer: CodebaseIndexer, db: Optional[Database] = None):
         self.indexer = indexer
-
-    def _configure(self):
+        self.db      = db   # backs the semantic answer cache when set
+        self._key    = ""
+        self._model  = None
+        self._lock   = threading.Lock()
+        # Runs refactor-suggestion calls alongside the main answer call.
+        self._pool   = ThreadPoolExecutor(max_workers=REFACTOR_WORKERS)
+
+    def _configure(self) -> genai.GenerativeModel:
+        """Return the shared model, reconfiguring the SDK only if the key changed."""
         api_key = os.getenv("GEMINI_API_KEY", "").strip()
         if not api_key:
             raise ValueError(
                 "GEMINI_API_KEY is not set. "
                 "Get a free key at https://aistudio.google.com/app/apikey"
             )
-        genai.configure(api_key=api_key)
+        with self._lock:
+            if api_key != self._key:
+                genai.configure(api_key=api_key)
+                self._key, self._model = api_key, None
+            if self._model is None:
+                self._model = genai.GenerativeModel(GEMINI_MODEL)
+            return self._model
+
+    def _cached_answer(self, session_id: str, query_vec: np.ndarray,
+                       generate_refactor: bool) -> Optional[Dict[str, Any]]:
+        rows = self.db.get_cached_vectors(
+            session_id, ANSWER_CACHE_TTL_S, need_refactor=generate_refactor)
+        if not rows:
+            return None
+        # Stored and query vectors are both unit length, so M @ q is cosine.
+        matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32)
+        sims   = matrix.reshape(len(rows), -1) @ query_vec
+        best   = int(sims.argmax())
+        if sims[best] < ANSWER_CACHE_MIN_SIM:
+            return None
+        result = self.db.get_cached_answer(session_id, rows[best][0])
+        if result is None:   # pruned between the two reads
+            return None
+        logger.info('"event":"answer_cache_hit","session":"%s","sim":%.3f',
+                    session_id, float(sims[best]))
+        if not generate_refactor:
+            # The entry may carry suggestions from an earlier ask; don't show
+            # them to a caller who didn't request any.
+            result["refactor_suggestions"] = None
+        return result
 
     def answer(self, session_id: str, question: str,
-               generate_refactor: bool = False) -> Dict[str, Any]:
-        self._configure()
+               generate_refactor: bool = False,
+               use_cache: bool = True) -> Dict[str, Any]:
+        """Answer a question and, when a Database is attached, record it.
 
-        chunks = self.indexer.search(session_id, question, top_k=8)
+        The history row and the semantic-cache entry are written in one
+        transaction; the returned dict then carries the new ``qa_id``.
+        """
+        self._configure()
+        # no_cache questions may be sensitive: keep them out of every cache.
+        query_vec   = self.indexer.embed_query(question, persist=use_cache)
+        use_cache   = use_cache and self.db is not None
+
+        result      = None
+        cache_entry = None
+        if use_cache:
+            result = self._cached_answer(session_id, query_vec, generate_refactor)
+        if result is None:
+            result = self._generate(session_id, question, query_vec, generate_refactor)
+            if use_cache and result["snippets"]:
+                cache_entry = (
+                    hashlib.sha256(question.encode("utf-8")).hexdigest(),
+                    query_vec.astype(np.float32).tobytes(),
+                    ANSWER_CACHE_TTL_S,
+                )
+
+        if self.db is not None:
+            result["qa_id"] = self.db.save_qa_batch(
+                session_id, question, result, cache_entry)
+        return result
+
+    def _generate(self, session_id: str, question: str, query_vec: np.ndarray,
+                  generate_refactor: bool) -> Dict[str, Any]:
+        chunks = self.indexer.search_by_vector(session_id, query_vec, top_k=8)
         if not chunks:
             logger.warning('"event":"no_chunks","session":"%s"', session_id)
             return {
@@ -45,28 +166,25 @@ class QAEngine:
                 "refactor_suggestions": None,
             }
 
-        context = "\n\n".join(
-            f"[{i+1}] {c['file']} (lines {c['line_start']}-{c['line_end']}):\n"
-            f"```\n{c['raw']}\n```"
-            for i, c in enumerate(chunks)
-        )
+        prompt = "".join((_PROMPT_PREFIX, question, _PROMPT_MIDDLE,
+                          _context(chunks), _PROMPT_SUFFIX))
 
-        prompt = (
-            "You are an expert code analyst. Answer the developer's question "
-            "using ONLY the provided code snippets below.\n\n"
-            f"QUESTION: {question}\n\n"
-            f"CODE SNIPPETS:\n{context}\n\n"
-            "INSTRUCTIONS:\n"
-            "- Give a clear, direct answer referencing specific file paths and line numbers.\n"
-            "- Format file references like: `filename.py (lines X-Y)`\n"
-            "- Quote short inline code using backticks when helpful.\n"
-            "- If the answer spans multiple files, explain how they interact.\n"
-            "- If the question cannot be answered from the snippets, say so clearly.\n"
-            "- Do NOT invent file paths or code that is not in the snippets.\n\n"
-            "Respond in markdown format."
-        )
+        model = self._configure()
+
+        # The refactor prompt only needs the top chunk, not the answer, so it
+        # runs on the pool while this thread waits on the answer call.
+        refactor_future = None
+        if generate_refactor:
+            top = chunks[0]
+            refactor_future = self._pool.submit(
+                model.generate_content,
+                "".join((_REFACTOR_PREFIX, top["file"],
+                         f" (lines {top['line_start']}-{top['line_end']})\n```\n",
+                         top["raw"], _REFACTOR_SUFFIX)),
+                generation_config=genai.GenerationConfig(
+                    temperature=0.3, max_output_tokens=800),
+            )
 
-        model    = genai.GenerativeModel(GEMINI_MODEL)
         response = model.generate_content(
             prompt,
             generation_config=genai.GenerationConfig(
@@ -77,21 +195,8 @@ class QAEngine:
                     session_id, len(chunks))
 
         refactor = None
-        if generate_refactor and chunks:
-            top = chunks[0]
-            r   = model.generate_content(
-                "You are a senior software engineer. "
-                "Review this code and give 3-5 concrete refactor suggestions.\n\n"
-                f"File: {top['file']} (lines {top['line_start']}-{top['line_end']})\n"
-                f"```\n{top['raw']}\n```\n\n"
-                "Format each suggestion as:\n"
-                "**Issue**: [problem]\n"
-                "**Suggestion**: [fix]\n"
-                "**Why**: [reason]",
-                generation_config=genai.GenerationConfig(
-                    temperature=0.3, max_output_tokens=800),
-            )
-            refactor = r.text.strip()
+        if refactor_future is not None:
+            refactor = refactor_future.result().text.strip()
 
         return {
             "answer":               answer_text,
@@ -100,16 +205,21 @@ class QAEngine:
         }
 
 
+def _context(chunks: List[Dict]) -> str:
+    """Numbered, fenced snippets for the prompt, each capped at
+    SNIPPET_PROMPT_CHARS so long chunks don't dominate the token budget."""
+    buf = io.StringIO()
+    for i, c in enumerate(chunks):
+        if i:
+            buf.write("\n\n")
+        raw = c["raw"]
+        buf.write(f"[{i+1}] {c['file']} (lines {c['line_start']}-{c['line_end']}):\n```\n")
+        buf.write(raw[:SNIPPET_PROMPT_CHARS])
+        if len(raw) > SNIPPET_PROMPT_CHARS:
+            buf.write("\n...")
+        buf.write("\n```")
+    return buf.getvalue()
+
+
 def _lang(filename: str) -> str:
-    ext_map = {
-        ".py": "python",   ".js": "javascript", ".ts": "typescript",
-        ".jsx": "jsx",     ".tsx": "tsx",        ".java": "java",
-        ".go": "go",       ".rb": "ruby",        ".rs": "rust",
-        ".cpp": "cpp",     ".c": "c",            ".h": "c",
-        ".hpp": "cpp",     ".cs": "csharp",      ".php": "php",
-        ".swift": "swift", ".kt": "kotlin",      ".sh": "bash",
-        ".bash": "bash",   ".yml": "yaml",       ".yaml": "yaml",
-        ".toml": "toml",   ".json": "json",      ".sql": "sql",
-        ".html": "html",   ".css": "css",        ".md": "markdown",
-    }
-    return ext_map.get(Path(filename).suffix.lower(), "text")
\ No newline at end of file
+    return _EXT_MAP.get(os.path.splitext(filename)[1].lower(), "text")
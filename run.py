@@ -19,8 +19,15 @@ if not os.getenv("GEMINI_API_KEY"):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
+    # Rate limits, semaphores and in-memory caches are per worker process,
+    # so more than one worker is opt-in.
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
     print(f"\n🔍 CodeLens — Codebase Q&A with Proof")
     print(f"   Running at: http://localhost:{port}")
     print(f"   Status:     http://localhost:{port}/status")
+    print(f"   Workers:    {workers}")
     print(f"   Ctrl+C to stop\n")
-    uvicorn.run("backend.main:app", host="0.0.0.0", port=port, reload=False)
\ No newline at end of file
+    # "auto" picks uvloop and httptools (uvicorn[standard]) when installed and
+    # falls back to asyncio / h11 where they aren't, e.g. uvloop on Windows.
+    uvicorn.run("backend.main:app", host="0.0.0.0", port=port, workers=workers,
+                loop="auto", http="auto", reload=False)
\ No newline at end of file
@@ -5,13 +5,21 @@ Run with: pytest tests/ -v
 
 import io
 import os
+import sqlite3
 import sys
+import tempfile
 import zipfile
 import pytest
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 os.environ.setdefault("GEMINI_API_KEY", "test_key_placeholder")
 
+# Keep the app's database, uploads and indexes out of the checkout.
+_STATE_DIR = tempfile.mkdtemp(prefix="codelens-tests-")
+os.environ.setdefault("DB_PATH", os.path.join(_STATE_DIR, "qa_history.db"))
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_STATE_DIR, "uploads"))
+os.environ.setdefault("INDEX_DIR", os.path.join(_STATE_DIR, "indexes"))
+
 from fastapi.testclient import TestClient
 from backend.main import app
 
@@ -60,6 +68,22 @@ def test_upload_invalid_zip_rejected():
                        files={"file": ("test.zip", b"not a zip at all", "application/zip")})
     assert resp.status_code == 400
 
+def test_upload_path_traversal_rejected():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("../evil.py", "print('x')")
+    resp = client.post("/api/upload",
+                       files={"file": ("evil.zip", buf.getvalue(), "application/zip")})
+    assert resp.status_code == 400
+    assert "traversal" in resp.json()["detail"].lower()
+
+def test_upload_oversize_rejected_from_content_length():
+    resp = client.post("/api/upload", content=b"x",
+                       headers={"content-length": str(60 * 1024 * 1024),
+                                "content-type": "multipart/form-data; boundary=x"})
+    assert resp.status_code == 400
+    assert "50 MB" in resp.json()["detail"]
+
 def test_upload_empty_filename():
     resp = client.post("/api/upload",
                        files={"file": ("", b"data", "application/zip")})
@@ -91,6 +115,38 @@ def test_ask_missing_session():
     })
     assert resp.status_code == 404
 
+def test_ask_single_flight_survives_leader_cancel(monkeypatch):
+    """Identical concurrent asks share one answer call, even if the first caller leaves."""
+    import asyncio
+    import threading
+    import backend.main as main
+
+    calls = []
+    release = threading.Event()
+
+    def fake_answer(session_id, question, generate_refactor, use_cache):
+        calls.append(question)
+        release.wait(5)
+        return {"qa_id": 7, "answer": "shared"}
+
+    monkeypatch.setattr(main.qa_engine, "answer", fake_answer)
+    req = main.QuestionRequest(session_id="00000000-0000-0000-0000-000000000001",
+                               question="Where is auth handled?")
+
+    async def scenario():
+        leader = asyncio.ensure_future(main._answer_once(req))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(main._answer_once(req))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await follower
+
+    assert asyncio.run(scenario()) == {"qa_id": 7, "answer": "shared"}
+    assert len(calls) == 1
+    assert not main.INFLIGHT
+
 
 # ── Session ────────────────────────────────────────────────────────────────────
 def test_get_nonexistent_session():
@@ -106,6 +162,23 @@ def test_export_nonexistent_session():
     resp = client.get("/api/export/nonexistent-session")
     assert resp.status_code == 404
 
+def test_session_id_alternate_uuid_forms():
+    """Braced, URN and 32-hex session ids resolve to the canonical session."""
+    import uuid
+    from backend.main import db
+
+    sid = uuid.uuid4()
+    db.create_session(str(sid), "src.zip", "zip", {})
+    db.save_qa(str(sid), "Where is auth handled?", {"answer": "In login.py"})
+
+    for form in (sid.hex.upper(), "{%s}" % sid, sid.urn):
+        assert client.get(f"/api/sessions/{form}").status_code == 200
+        assert len(client.get(f"/api/history/{form}").json()["history"]) == 1
+        assert client.get(f"/api/export/{form}").status_code == 200
+    resp = client.post("/api/search-history",
+                       json={"session_id": sid.hex, "query": "auth"})
+    assert len(resp.json()["results"]) == 1
+
 
 # ── Indexer unit tests ─────────────────────────────────────────────────────────
 def test_indexer_chunking():
@@ -139,6 +212,19 @@ def test_indexer_skips_no_code_files():
             idx.index_directory("test-session", tmpdir)
 
 
+def test_indexer_skips_binary_with_code_extension():
+    """A NUL-containing file is skipped even when its extension is indexable."""
+    import tempfile
+    from pathlib import Path
+    from backend.indexer import CodebaseIndexer
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (Path(tmpdir) / "blob.json").write_bytes(b"\x00\x01\x02\x03" * 64)
+        idx = CodebaseIndexer(str(Path(tmpdir) / "index"))
+        with pytest.raises(ValueError, match="No indexable"):
+            idx.index_directory("test-session", tmpdir)
+
+
 def test_indexer_windows_path_separator():
     """File paths should always use forward slashes."""
     from backend.indexer import CodebaseIndexer
@@ -148,4 +234,393 @@ def test_indexer_windows_path_separator():
     # This tests the chunk structure
     assert "file" in chunks[0]
     assert "line_start" in chunks[0]
-    assert "raw" in chunks[0]
\ No newline at end of file
+    assert "raw" in chunks[0]
+
+
+def _fake_vec(text: str):
+    import zlib
+    import numpy as np
+    rng = np.random.default_rng(zlib.crc32(text.encode()))
+    v = rng.standard_normal(64).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def test_index_search_round_trip_reuses_cache(monkeypatch):
+    """index_directory → search_by_vector finds a chunk by its own vector; re-indexing hits the cache."""
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    import backend.indexer as indexer_mod
+    from backend.indexer import CodebaseIndexer
+
+    embedded = []
+
+    async def fake_embed(client, chunks):
+        embedded.extend(chunks)
+        return np.stack([_fake_vec(c["raw"]) for c in chunks])
+
+    monkeypatch.setattr(indexer_mod, "_embed_chunks_async", fake_embed)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = Path(tmpdir) / "src"
+        src.mkdir()
+        (src / "auth.py").write_text("def login(user):\n    return user\n")
+        (src / "db.py").write_text("def connect(url):\n    return url\n")
+        idx = CodebaseIndexer(str(Path(tmpdir) / "index"))
+
+        idx.index_directory("s1", str(src))
+        assert len(embedded) == 2
+        assert idx.has_index("s1")
+
+        target = next(c for c in embedded if c["file"] == "db.py")
+        hits = idx.search_by_vector("s1", _fake_vec(target["raw"]), top_k=2)
+        assert hits[0]["file"] == "db.py"
+        assert hits[0]["score"] > 0.99
+
+        idx.index_directory("s2", str(src))
+        assert len(embedded) == 2
+        hits = idx.search_by_vector("s2", _fake_vec(target["raw"]), top_k=1)
+        assert hits[0]["file"] == "db.py"
+
+
+def test_embed_retries_transient_errors_and_cancels_siblings(monkeypatch):
+    """503s and transport errors are retried; a batch that fails for good stops the rest."""
+    import asyncio
+    import httpx
+    import orjson
+    import backend.indexer as indexer_mod
+
+    monkeypatch.setattr(indexer_mod, "EMBED_BACKOFF_S", 0)
+    monkeypatch.setattr(indexer_mod, "EMBED_BATCH_SIZE", 1)
+    chunk = {"file": "a.py", "line_start": 1, "line_end": 1, "raw": "x = 1"}
+    ok = orjson.dumps({"embeddings": [{"values": [3.0, 4.0]}]})
+
+    replies = iter(["drop", 503, 200])
+
+    def flaky(request):
+        reply = next(replies)
+        if reply == "drop":
+            raise httpx.ConnectError("reset", request=request)
+        return httpx.Response(reply, content=ok)
+
+    async def embed(handler, chunks):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as c:
+            return await indexer_mod._embed_chunks_async(c, chunks)
+
+    vecs = asyncio.run(embed(flaky, [chunk]))
+    assert vecs.shape == (1, 2) and abs(vecs[0, 0] - 0.6) < 1e-6
+
+    started, cancelled = [], []
+
+    async def failing(request):
+        started.append(request)
+        if len(started) == 1:
+            await asyncio.sleep(0.05)   # let the other batches get going
+            return httpx.Response(400)
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(request)
+            raise
+        return httpx.Response(200, content=ok)
+
+    async def scenario():
+        with pytest.raises(httpx.HTTPStatusError):
+            await embed(failing, [chunk] * 3)
+        await asyncio.sleep(0.05)
+        # Checked inside the loop: asyncio.run cancels leftovers on exit.
+        assert len(started) == 3 and len(cancelled) == 2
+
+    asyncio.run(scenario())
+
+
+def test_legacy_pickle_index_migrated():
+    """A pre-Arrow index (chunks.pkl + float32 embeddings) is converted on first use."""
+    import pickle
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    from backend.indexer import CodebaseIndexer
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        idx = CodebaseIndexer(tmpdir)
+        session_dir = Path(tmpdir) / "old"
+        session_dir.mkdir()
+        chunks = [{"file": f, "line_start": 1, "line_end": 2, "text": raw, "raw": raw}
+                  for f, raw in (("a.py", "import os"), ("b.py", "import sys"))]
+        with open(session_dir / "chunks.pkl", "wb") as f:
+            pickle.dump(chunks, f)
+        np.save(session_dir / "embeddings.npy",
+                np.stack([_fake_vec(c["raw"]) for c in chunks]))
+
+        assert idx.has_index("old")
+        assert (session_dir / "chunks.arrow").exists()
+        assert np.load(session_dir / "embeddings.npy").dtype == np.int8
+        hits = idx.search_by_vector("old", _fake_vec("import sys"), top_k=1)
+        assert hits[0]["file"] == "b.py"
+
+
+def test_failed_legacy_migration_not_retried():
+    """A legacy index that can't be converted is attempted once per process."""
+    import tempfile
+    from pathlib import Path
+    from backend.indexer import CodebaseIndexer
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        idx = CodebaseIndexer(tmpdir)
+        session_dir = Path(tmpdir) / "broken"
+        session_dir.mkdir()
+        (session_dir / "chunks.pkl").write_bytes(b"not a pickle")
+        (session_dir / "embeddings.npy").write_bytes(b"not an array")
+
+        attempts = []
+        migrate = idx._migrate_legacy
+        idx._migrate_legacy = lambda d: attempts.append(d) or migrate(d)
+        assert not idx.has_index("broken")
+        assert not idx.has_index("broken")
+        assert len(attempts) == 1
+
+
+def test_embedding_cache_evicts_oldest(monkeypatch):
+    """put_many keeps at most CACHE_ROWS chunk embeddings, dropping the oldest."""
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    import backend.indexer as indexer_mod
+    from backend.indexer import EmbeddingCache
+
+    monkeypatch.setattr(indexer_mod, "CACHE_ROWS", 2)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = EmbeddingCache(str(Path(tmpdir) / "cache.sqlite"))
+        codes = np.ones((3, 4), dtype=np.int8)
+        cache.put_many(["a", "b"], codes[:2], np.ones(2, dtype=np.float32))
+        cache.put_many(["c"], codes[2:], np.ones(1, dtype=np.float32))
+        assert sorted(cache.get_many(["a", "b", "c"])) == ["b", "c"]
+
+
+def test_query_embed_cache_bounded_and_skipped_for_no_cache(monkeypatch):
+    """put_query evicts the oldest rows; persist=False never writes to the cache."""
+    import tempfile
+    import numpy as np
+    import backend.indexer as indexer_mod
+    from backend.indexer import CodebaseIndexer
+
+    monkeypatch.setattr(indexer_mod, "QUERY_CACHE_ROWS", 2)
+    monkeypatch.setattr(indexer_mod, "_embed_query",
+                        lambda q: _fake_vec(q).reshape(1, -1))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        idx = CodebaseIndexer(tmpdir)
+        for q in ("one", "two", "three"):
+            idx.embed_query(q)
+        count = "SELECT COUNT(*) FROM query_embed_cache"
+        assert idx._cache._c.execute(count).fetchone()[0] == 2
+
+        vec = idx.embed_query("secret", persist=False)
+        assert np.allclose(vec, _fake_vec("secret"))
+        assert idx._cache._c.execute(count).fetchone()[0] == 2
+
+# ── Database unit tests ────────────────────────────────────────────────────────
+def test_search_history_substring_match():
+    """Full-text search keeps LIKE's case-insensitive substring semantics."""
+    import tempfile
+    from pathlib import Path
+    from backend.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        db.create_session("s1", "src.zip", "zip", {})
+        db.save_qa("s1", "Where is Authentication handled?", {"answer": "In login.py"})
+        db.save_qa("s1", "How is the DB connected?", {"answer": "Via sqlite3"})
+
+        assert [r["question"] for r in db.search_history("s1", "thentic")] == \
+            ["Where is Authentication handled?"]
+        assert len(db.search_history("s1", "SQLITE")) == 1
+        assert len(db.search_history("s1", "DB")) == 1
+        assert db.search_history("s2", "login") == []
+
+
+@pytest.mark.parametrize("aggregate_order_by", [
+    pytest.param(True, marks=pytest.mark.skipif(
+        sqlite3.sqlite_version_info < (3, 44, 0),
+        reason="aggregate ORDER BY needs SQLite 3.44+")),
+    False,
+])
+def test_search_history_order(monkeypatch, aggregate_order_by):
+    """Short queries return newest first; full-text matches return best match first."""
+    import tempfile
+    from pathlib import Path
+    import backend.database as database_mod
+    from backend.database import Database
+
+    # False is the path SQLite < 3.44 takes: rows are sorted after decoding.
+    monkeypatch.setattr(database_mod, "_AGGREGATE_ORDER_BY", aggregate_order_by)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        db.create_session("s1", "src.zip", "zip", {})
+        db.save_qa("s1", "auth auth auth", {"answer": "auth"})
+        db.save_qa("s1", "Where is the config loaded?",
+                   {"answer": "auth is mentioned once in a much longer answer about config"})
+        db.save_qa("s1", "What does main do?", {"answer": "auth"})
+        for n, q in enumerate(["auth auth auth", "Where is the config loaded?",
+                               "What does main do?"]):
+            db._c.execute("UPDATE qa_history SET created_at=? WHERE question=?",
+                          (f"2026-01-0{n + 1}T00:00:00", q))
+
+        assert [r["question"] for r in db.search_history("s1", "a")] == \
+            ["What does main do?", "Where is the config loaded?", "auth auth auth"]
+        matches = db.search_history("s1", "auth")
+        assert matches[0]["question"] == "auth auth auth"
+        assert all("_rank" not in r for r in matches)
+        assert [r["question"] for r in db.get_history("s1")][0] == "What does main do?"
+
+
+def test_bulk_tag_and_delete():
+    import tempfile
+    from pathlib import Path
+    from backend.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        db.create_session("s1", "src.zip", "zip", {})
+        ids = [db.save_qa("s1", f"q{i}", {"answer": "a"}) for i in range(3)]
+
+        assert db.update_tags_bulk([(ids[0], ["auth"]), (ids[1], ["db", "perf"]),
+                                    ("missing", ["x"])]) == 2
+        tags = {r["id"]: r["tags"] for r in db.get_history("s1")}
+        assert tags == {ids[0]: ["auth"], ids[1]: ["db", "perf"], ids[2]: []}
+
+        assert db.delete_qa_bulk(ids[:2] + ["missing"]) == 2
+        assert [r["id"] for r in db.get_history("s1")] == [ids[2]]
+
+
+def test_tags_bulk_endpoint():
+    resp = client.post("/api/tags-bulk", json={
+        "items": [{"qa_id": "does-not-exist", "tags": [" Auth "]}],
+    })
+    assert resp.status_code == 200
+    assert resp.json() == {"status": "ok", "updated": 0}
+
+
+def test_history_delete_bulk_endpoint():
+    resp = client.post("/api/history-delete-bulk", json={"qa_ids": ["does-not-exist"]})
+    assert resp.status_code == 200
+    assert resp.json() == {"status": "deleted", "deleted": 0}
+    resp = client.post("/api/history-delete-bulk", json={"qa_ids": ["x"] * 101})
+    assert resp.status_code == 422
+
+
+def test_answer_cache_roundtrip():
+    import tempfile
+    from pathlib import Path
+    from backend.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        result = {"answer": "a", "snippets": [], "refactor_suggestions": None}
+        db.cache_answer("s1", "h1", b"\x00" * 8, result, max_age_s=60)
+
+        assert db.get_cached_vectors("s1", 60) == [("h1", b"\x00" * 8)]
+        assert db.get_cached_vectors("s1", 60, need_refactor=True) == []
+        assert db.get_cached_vectors("s2", 60) == []
+        assert db.get_cached_answer("s1", "h1") == result
+        assert db.get_cached_answer("s2", "h1") is None
+
+
+def test_save_qa_batch_writes_history_and_cache():
+    import tempfile
+    from pathlib import Path
+    from backend.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        db.create_session("s1", "src.zip", "zip", {})
+        result = {"answer": "a", "snippets": [], "refactor_suggestions": None}
+        qa_id = db.save_qa_batch("s1", "q", result, ("h1", b"\x00" * 8, 60))
+
+        assert [r["id"] for r in db.get_history("s1")] == [qa_id]
+        assert db.get_cached_vectors("s1", 60) == [("h1", b"\x00" * 8)]
+        assert db.get_cached_answer("s1", "h1") == result
+
+
+def test_iter_history_pages_match_get_history():
+    import tempfile
+    from pathlib import Path
+    from backend.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        db.create_session("s1", "src.zip", "zip", {})
+        for i in range(7):
+            db.save_qa("s1", f"q{i}", {"answer": "a"})
+
+        assert list(db.iter_history("s1", page_size=3)) == db.get_history("s1")
+        assert db.count_history("s1") == 7
+
+
+def test_answer_cache_capped_per_session():
+    import tempfile
+    from pathlib import Path
+    from backend import database
+    from backend.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(str(Path(tmpdir) / "qa.db"))
+        result = {"answer": "a", "snippets": [], "refactor_suggestions": None}
+        for i in range(database.MAX_CACHED_ANSWERS + 5):
+            db.cache_answer("s1", f"h{i}", b"\x00" * 8, result, max_age_s=60)
+        db.cache_answer("s2", "h0", b"\x00" * 8, result, max_age_s=60)
+
+        kept = {h for h, _ in db.get_cached_vectors("s1", 60)}
+        assert len(kept) == database.MAX_CACHED_ANSWERS
+        assert "h0" not in kept and f"h{database.MAX_CACHED_ANSWERS + 4}" in kept
+        assert len(db.get_cached_vectors("s2", 60)) == 1
+
+
+# ── QAEngine unit tests ────────────────────────────────────────────────────────
+def _stub_engine(monkeypatch, tmpdir):
+    """QAEngine over a temp Database with retrieval and Gemini stubbed out."""
+    import types
+    import numpy as np
+    from pathlib import Path
+    from backend import qa_engine
+    from backend.database import Database
+
+    calls = []
+
+    class FakeModel:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def generate_content(self, prompt, **kwargs):
+            calls.append(prompt)
+            text = "REFACTOR" if "refactor suggestions" in prompt else "ANSWER"
+            return types.SimpleNamespace(text=text)
+
+    class FakeIndexer:
+        def embed_query(self, question, persist=True):
+            return np.ones(8, dtype=np.float32) / np.sqrt(8)
+
+        def search_by_vector(self, session_id, query_vec, top_k=8):
+            return [{"file": "a.py", "line_start": 1, "line_end": 2, "raw": "x = 1"}]
+
+    monkeypatch.setattr(qa_engine.genai, "configure", lambda **kwargs: None)
+    monkeypatch.setattr(qa_engine.genai, "GenerativeModel", FakeModel)
+    db = Database(str(Path(tmpdir) / "qa.db"))
+    db.create_session("s1", "src.zip", "zip", {})
+    return qa_engine.QAEngine(FakeIndexer(), db), calls
+
+
+def test_answer_cache_hit_drops_unrequested_refactor(monkeypatch):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine, calls = _stub_engine(monkeypatch, tmpdir)
+        first = engine.answer("s1", "q1", generate_refactor=True)
+        assert first["refactor_suggestions"] == "REFACTOR"
+
+        hit = engine.answer("s1", "q2", generate_refactor=False)
+        assert len(calls) == 2            # answer + refactor, nothing new
+        assert hit["answer"] == "ANSWER"
+        assert hit["refactor_suggestions"] is None